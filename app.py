@@ -1,15 +1,34 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
 from lxml import etree
+import cachetools
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import multiprocessing
 import os
+from concurrent.futures.process import BrokenProcessPool
 
-app = FastAPI(title="Validador NF-e Local")
+app = FastAPI(title="Validador NF-e Local", default_response_class=ORJSONResponse)
 
 # Caminho para os XSDs locais
 XSD_DIR = "./xsd"  # coloque seus XSDs aqui (ex: enviNFe_v4.00.xsd)
 
-# Função para carregar o XSD
+# Tag raiz -> XSD usado na validação
+ROOT_XSD_MAP = {
+    "enviNFe": "enviNFe_v4.00.xsd",
+}
+
+# Parser único por processo: sem tabela de IDs e sem resolver entidades (evita XXE).
+# O lxml serializa o uso concorrente do mesmo parser, então pode ser compartilhado.
+_NFE_PARSER = etree.XMLParser(
+    collect_ids=False, resolve_entities=False, huge_tree=False
+)
+
+# Função para carregar o XSD (compilado uma única vez por processo)
+@functools.lru_cache(maxsize=None)
 def carregar_xsd(xsd_file: str):
     try:
         with open(os.path.join(XSD_DIR, xsd_file), 'rb') as f:
@@ -18,21 +37,44 @@ def carregar_xsd(xsd_file: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao carregar XSD: {e}")
 
+# Pré-carrega os XSDs na subida da API para a primeira requisição não pagar a compilação
+@app.on_event("startup")
+def preload_xsd():
+    for xsd_file in ROOT_XSD_MAP.values():
+        carregar_xsd(xsd_file)
+
+# CSTs aceitos nas regras de negócio
+_VALID_CST = frozenset({
+    "00","01","02","03","04","05","49","50","51","52","53","54","55","99"
+})
+
+# Namespace da NF-e
+_NS = "http://www.portalfiscal.inf.br/nfe"
+_NSMAP = {"nfe": _NS}
+
+# XPaths das regras de negócio, compilados uma vez
+# (primeiro CST de cada item e Id do primeiro infNFe)
+_XP_CST = etree.XPath(
+    "//nfe:det/descendant::nfe:CST[1]",
+    namespaces=_NSMAP,
+)
+_XP_INFNFE_ID = etree.XPath(
+    "(//nfe:infNFe)[1]/@Id",
+    namespaces=_NSMAP,
+)
+
 # Validação de regras de negócio básicas
 def validar_regras_negocio(xml_root):
     erros = []
 
     # Exemplo: CST obrigatório
-    for det in xml_root.findall(".//{http://www.portalfiscal.inf.br/nfe}det"):
-        cst = det.find(".//{http://www.portalfiscal.inf.br/nfe}CST")
-        if cst is not None and cst.text not in [
-            "00","01","02","03","04","05","49","50","51","52","53","54","55","99"
-        ]:
+    for cst in _XP_CST(xml_root):
+        if cst.text not in _VALID_CST:
             erros.append(f"CST inválido: {cst.text}")
 
     # Exemplo: campo Id obrigatório
-    chave = xml_root.find(".//{http://www.portalfiscal.inf.br/nfe}infNFe")
-    if chave is None or not chave.get("Id"):
+    ids = _XP_INFNFE_ID(xml_root)
+    if not ids or not ids[0]:
         erros.append("Campo Id da NFe obrigatório ausente")
 
     return erros
@@ -41,64 +83,151 @@ def validar_regras_negocio(xml_root):
 class XmlRequest(BaseModel):
     xml: str
 
-# Endpoint principal
-@app.post("/nfe/validate-xml")
-async def validate_xml(request: Request):
-    """
-    Aceita XML cru ou JSON:
-    - JSON: {"xml": "<xml>...</xml>"}
-    - Body puro: <xml>...</xml>
-    """
-    # Detecta se é JSON ou texto cru
-    try:
-        data = await request.json()
-        xml_string = data.get("xml", "")
-    except:
-        xml_string = await request.body()
-        xml_string = xml_string.decode("utf-8")
+# Limite de XMLs por chamada ao lote
+MAX_XMLS_LOTE = 1000
 
-    if not xml_string.strip():
-        return JSONResponse(
-            status_code=400,
-            content={"sucesso": False, "mensagem": "Nenhum XML fornecido"}
-        )
+# Modelo para validação em lote
+class XmlBatchRequest(BaseModel):
+    xmls: list[str] = Field(max_length=MAX_XMLS_LOTE)
+
+# Validação completa de um XML (parse, XSD e regras de negócio)
+def validar_xml(xml_bytes: bytes, schema) -> tuple[int, dict]:
+    if not xml_bytes.strip():
+        return 400, {"sucesso": False, "mensagem": "Nenhum XML fornecido"}
 
     # Parse do XML
     try:
-        xml_doc = etree.fromstring(xml_string.encode("utf-8"))
+        xml_doc = etree.fromstring(xml_bytes, _NFE_PARSER)
     except Exception as e:
-        return JSONResponse(
-            status_code=400,
-            content={"sucesso": False, "mensagem": f"Erro ao ler XML: {e}"}
-        )
+        return 400, {"sucesso": False, "mensagem": f"Erro ao ler XML: {e}"}
+
+    # NF-e não usa DTD; entidades não resolvidas quebrariam a validação XSD
+    if xml_doc.getroottree().docinfo.doctype:
+        return 400, {"sucesso": False, "mensagem": "Erro ao ler XML: DTD/entidades não são permitidos"}
 
     # Validação XSD (enviNFe)
     try:
-        schema = carregar_xsd("enviNFe_v4.00.xsd")  # agora usa enviNFe_v4.00.xsd
         schema.assertValid(xml_doc)
-    except etree.DocumentInvalid as e:
-        return JSONResponse(
-            status_code=400,
-            content={"sucesso": False, "mensagem": f"Erro de validação XSD: {str(e)}"}
-        )
+    except (etree.DocumentInvalid, etree.XMLSchemaValidateError) as e:
+        return 400, {"sucesso": False, "mensagem": f"Erro de validação XSD: {str(e)}"}
 
     # Validação regras de negócio
     erros_negocio = validar_regras_negocio(xml_doc)
     if erros_negocio:
-        return JSONResponse(
-            status_code=400,
-            content={"sucesso": False, "mensagem": "Erros de regras de negócio", "detalhes": erros_negocio}
-        )
-
-    return JSONResponse(
-        status_code=200,
-        content={"sucesso": True, "mensagem": "XML válido e regras de negócio conferidas!"}
+        return 400, {"sucesso": False, "mensagem": "Erros de regras de negócio", "detalhes": erros_negocio}
+
+    return 200, {"sucesso": True, "mensagem": "XML válido e regras de negócio conferidas!"}
+
+# Pool de processos para validação em lote: cada worker compila os XSDs uma vez
+# na inicialização e valida um XML por vez, sem disputar o GIL com a API.
+# Usa "spawn" para não fazer fork de um servidor que já tem threads rodando.
+_POOL = None
+
+def _criar_pool():
+    workers = os.cpu_count()
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=preload_xsd,
     )
+    # Com "spawn" os workers sobem sob demanda: uma tarefa por worker já sobe todos
+    # (import do app e compilação dos XSDs) antes do primeiro lote
+    for _ in range(workers):
+        pool.submit(preload_xsd)
+    return pool
+
+@app.on_event("startup")
+def iniciar_pool():
+    global _POOL
+    _POOL = _criar_pool()
+
+@app.on_event("shutdown")
+def encerrar_pool():
+    if _POOL is not None:
+        _POOL.shutdown(cancel_futures=True)
+
+# Um worker morto (ex: OOM) quebra o pool inteiro: troca por um novo
+def _recriar_pool(pool_quebrado):
+    global _POOL
+    if _POOL is pool_quebrado:
+        pool_quebrado.shutdown(wait=False, cancel_futures=True)
+        _POOL = _criar_pool()
+
+def _validar_no_pool(xml_string: str) -> dict:
+    schema = carregar_xsd(ROOT_XSD_MAP["enviNFe"])
+    _, conteudo = validar_xml(xml_string.encode("utf-8"), schema)
+    return conteudo
+
+# Executa no pool; devolve None se o pool quebrou durante (ou antes) da validação
+# e um erro do próprio item para qualquer outra falha, sem derrubar o lote
+async def _validar_em_pool(pool, xml_string: str):
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, _validar_no_pool, xml_string)
+    except BrokenProcessPool:
+        return None
+    except Exception as e:
+        return {"sucesso": False, "mensagem": f"Erro interno: {e}"}
+
+# Resultados já calculados, pelo hash do XML
+_RESULT_CACHE = cachetools.LRUCache(maxsize=10_000)
+
+# Endpoint principal
+@app.post("/nfe/validate-xml", response_model=None)
+async def validate_xml(request: Request):
+    """
+    Aceita XML cru ou JSON:
+    - JSON: {"xml": "<xml>...</xml>"}
+    - Body puro: <xml>...</xml>
+    """
+    # Detecta se é JSON ou texto cru (o corpo cru vai direto em bytes para o lxml)
+    try:
+        data = await request.json()
+        xml_bytes = data.get("xml", "").encode("utf-8")
+    except:
+        xml_bytes = await request.body()
+
+    # Hash do XML: chave do cache de resultados
+    chave = hashlib.blake2b(xml_bytes, digest_size=16).digest()
+
+    resultado = _RESULT_CACHE.get(chave)
+    if resultado is None:
+        schema = carregar_xsd(ROOT_XSD_MAP["enviNFe"])  # agora usa enviNFe_v4.00.xsd
+        resultado = _RESULT_CACHE[chave] = validar_xml(xml_bytes, schema)
+    status_code, conteudo = resultado
+    return ORJSONResponse(status_code=status_code, content=conteudo)
+
+# Validação em lote
+@app.post("/nfe/validate-xml/batch", response_model=None)
+async def validate_xml_batch(req: XmlBatchRequest):
+    """
+    Recebe {"xmls": ["<xml>...</xml>", ...]} e valida cada XML em paralelo.
+    Os resultados seguem a ordem da lista recebida.
+    """
+    pool = _POOL
+    resultados = await asyncio.gather(*[_validar_em_pool(pool, x) for x in req.xmls])
+
+    # Pool quebrado: recria e tenta de novo, uma vez, só os XMLs que falharam
+    falhas = [i for i, r in enumerate(resultados) if r is None]
+    if falhas:
+        _recriar_pool(pool)
+        pool = _POOL
+        refeitos = await asyncio.gather(*[_validar_em_pool(pool, req.xmls[i]) for i in falhas])
+        for i, conteudo in zip(falhas, refeitos):
+            if conteudo is None:
+                _recriar_pool(pool)
+                conteudo = {"sucesso": False, "mensagem": "Erro interno: o processo de validação foi encerrado"}
+            resultados[i] = conteudo
+
+    return ORJSONResponse({"resultados": resultados})
 
 # Endpoint raiz
-@app.get("/")
+@app.get("/", response_model=None)
 def root():
-    return {"status": "ok", "mensagem": "API Validador NF-e Local rodando!"}
+    return ORJSONResponse(
+        {"status": "ok", "mensagem": "API Validador NF-e Local rodando!"},
+        headers={"Cache-Control": "public, max-age=60"},
+    )
 
 # Execução direta
 if __name__ == "__main__":